@@ -1,13 +1,31 @@
 import os
 import logging
-import re
+import secrets
 import datetime
+import html
 import asyncio
+import contextlib
+import functools
+import time
+import weakref
+import pickle
+from collections import OrderedDict, defaultdict
 from dotenv import load_dotenv
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 import google.generativeai as genai
-from telegram import Update, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup, Poll
+from google.generativeai.types import generation_types
+from telegram import Update, ChatMember, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup, Poll
 from telegram.constants import ParseMode, ChatType
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -15,103 +33,223 @@ from telegram.ext import (
     ContextTypes,
     CallbackQueryHandler,
     ChatMemberHandler,
+    PersistenceInput,
+    PicklePersistence,
 )
 
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Point this at a mounted persistent disk; Render's default filesystem is wiped on every deploy.
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE")
+PORT = int(os.getenv("PORT", 8443))
+RENDER_URL = os.getenv("RENDER_URL")
+BOT_MODE = os.getenv("BOT_MODE", "webhook").lower()
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_hex(32)
+ALLOWED_CHATS = frozenset(int(c) for c in os.getenv("ALLOWED_CHATS", "").split(",") if c.strip())
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
+logging.logThreads = logging.logProcesses = logging.logMultiprocessing = False
 logger = logging.getLogger(__name__)
 
 available_models = []
+available_model_set = frozenset()
 DEFAULT_MODEL = "gemini-pro"
 
 try:
     genai.configure(api_key=GEMINI_API_KEY)
 except Exception as e:
-    logger.error(f"Failed to configure Gemini: {e}")
+    logger.error("Failed to configure Gemini: %s", e)
 
 def fetch_available_models():
-    global available_models, DEFAULT_MODEL
+    global available_models, available_model_set, DEFAULT_MODEL
     if not GEMINI_API_KEY:
         logger.error("No GEMINI_API_KEY found. Using fallback model list.")
         available_models = [DEFAULT_MODEL]
-        return
-
-    try:
-        models_list = genai.list_models()
-        valid_models = [m.name.replace('models/', '') for m in models_list if 'generateContent' in m.supported_generation_methods]
-        
-        if valid_models:
-            available_models = valid_models
-            DEFAULT_MODEL = available_models[0]
-        else:
-            available_models = [DEFAULT_MODEL]
+    else:
+        try:
+            models_list = genai.list_models()
+            valid_models = [m.name.replace('models/', '') for m in models_list if 'generateContent' in m.supported_generation_methods]
             
-        logger.info(f"Available models set to: {available_models}")
-        logger.info(f"Default model set to: {DEFAULT_MODEL}")
-    except Exception as e:
-        logger.error(f"Failed to fetch models: {e}. Falling back to default.")
-        available_models = [DEFAULT_MODEL]
+            if valid_models:
+                available_models = valid_models
+                DEFAULT_MODEL = available_models[0]
+            else:
+                available_models = [DEFAULT_MODEL]
+                
+            logger.info("Available models set to: %s", available_models)
+            logger.info("Default model set to: %s", DEFAULT_MODEL)
+        except Exception as e:
+            logger.error("Failed to fetch models: %s. Falling back to default.", e)
+            available_models = [DEFAULT_MODEL]
 
-user_states = {}
-group_states = {}
-tictactoe_games = {}
+    available_model_set = frozenset(available_models)
+
+@functools.lru_cache(maxsize=256)
+def get_model(model_name, instructions):
+    return genai.GenerativeModel(
+        model_name=model_name,
+        system_instruction=instructions
+    )
+
+class LRUDict(OrderedDict):
+    """Dict that drops its least recently used entry once it grows past maxsize."""
+
+    def __init__(self, maxsize=None, *args, on_evict=None, **kwargs):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        super().__init__(*args, **kwargs)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if self.maxsize is not None and len(self) > self.maxsize:
+            evicted, _ = self.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(evicted)
+
+MAX_USER_STATES = 10_000
+MAX_GROUP_STATES = 5_000
+MAX_HISTORY = 20
+
+# Replaced by the Application's user_data/chat_data in post_init so PTB persists them per entry.
+user_states = defaultdict(dict)
+group_states = defaultdict(dict)
+recent_users = LRUDict(MAX_USER_STATES)
+recent_groups = LRUDict(MAX_GROUP_STATES)
 
 CENSORED_WORDS = [
     'nigger', 'nigga', 'faggot', 'fag', 'cunt', 'bitch', 
     'dick', 'pussy', 'motherfucker', 'mf', 'fuck', 'shit'
 ]
 
+def slim_history(contents):
+    return [
+        {"role": content.role, "parts": [part.text for part in content.parts if part.text]}
+        for content in contents
+    ]
+
+user_locks = weakref.WeakValueDictionary()
+
+def get_user_lock(user_id):
+    lock = user_locks.get(user_id)
+    if lock is None:
+        lock = user_locks[user_id] = asyncio.Lock()
+    return lock
+
 def get_user_state(user_id):
-    if user_id not in user_states:
-        user_states[user_id] = {
-            "history": [],
-            "model": DEFAULT_MODEL,
-            "instructions": "You are a helpful assistant.",
-            "incognito": False,
-        }
-    return user_states[user_id]
+    recent_users[user_id] = None
+    state = user_states[user_id]
+    if not state:
+        state.update(
+            history=[],
+            model=DEFAULT_MODEL,
+            instructions="You are a helpful assistant.",
+            incognito=False,
+        )
+    return state
+
+@contextlib.asynccontextmanager
+async def user_state(user_id):
+    async with get_user_lock(user_id):
+        yield get_user_state(user_id)
+
+def split_template(message):
+    return tuple(message.split("{user}"))
 
 def get_group_state(chat_id):
-    if chat_id not in group_states:
-        group_states[chat_id] = {
-            "warnings": {},
-            "roles": {},
-            "automode": "normal",
-            "welcome_msg": "Welcome {user} to the group!",
-            "leaving_msg": "Goodbye {user}!",
-        }
-    return group_states[chat_id]
+    recent_groups[chat_id] = None
+    group = group_states[chat_id]
+    if not group:
+        group.update(
+            warnings=defaultdict(int),
+            roles={},
+            automode="normal",
+            welcome_parts=split_template("Welcome {user} to the group!"),
+            leaving_parts=split_template("Goodbye {user}!"),
+        )
+    return group
+
+ADMIN_CACHE_TTL = 90
+ADMIN_CACHE_MAX_CHATS = 5000
+admin_cache = {}
+ADMIN_STATUSES = {ChatMember.ADMINISTRATOR, ChatMember.OWNER}
 
 async def is_admin(chat_id, user_id, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    cached = admin_cache.get(chat_id)
+    if cached and time.monotonic() < cached[1]:
+        return user_id in cached[0]
+
     try:
         admins = await context.bot.get_chat_administrators(chat_id)
-        return user_id in [admin.user.id for admin in admins]
     except Exception as e:
-        logger.error(f"Error checking admin status: {e}")
+        logger.error("Error checking admin status: %s", e)
         return False
 
+    if len(admin_cache) > ADMIN_CACHE_MAX_CHATS:
+        admin_cache.clear()
+    admin_ids = {admin.user.id for admin in admins}
+    admin_cache[chat_id] = (admin_ids, time.monotonic() + ADMIN_CACHE_TTL)
+    return user_id in admin_ids
+
+async def track_admin_changes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    member_update = update.chat_member
+    was_admin = member_update.old_chat_member.status in ADMIN_STATUSES
+    now_admin = member_update.new_chat_member.status in ADMIN_STATUSES
+    if was_admin != now_admin:
+        admin_cache.pop(member_update.chat.id, None)
+
+def admin_only(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not await is_admin(update.effective_chat.id, update.effective_user.id, context):
+            await update.message.reply_text("You're not an admin, my guy.")
+            return
+        return await handler(update, context)
+    return wrapper
+
+MUTED_PERMISSIONS = ChatPermissions(can_send_messages=False)
+UNMUTED_PERMISSIONS = ChatPermissions(
+    can_send_messages=True,
+    can_send_audios=True,
+    can_send_documents=True,
+    can_send_photos=True,
+    can_send_videos=True,
+    can_send_video_notes=True,
+    can_send_voice_notes=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True
+)
+
+def get_command_text(update: Update) -> str:
+    parts = update.message.text.split(maxsplit=1)
+    return parts[1] if len(parts) > 1 else ""
+
+DURATION_UNITS = {
+    "minute": datetime.timedelta(minutes=1),
+    "hour": datetime.timedelta(hours=1),
+    "day": datetime.timedelta(days=1),
+    "week": datetime.timedelta(weeks=1),
+    "month": datetime.timedelta(days=30),
+}
+
 def parse_duration(text: str) -> datetime.timedelta | None:
-    match = re.match(r"(\d+)\s+(minute|minutes|day|days|week|weeks|month|months)", text, re.IGNORECASE)
-    if not match:
+    amount, _, unit = text.partition(" ")
+    if not amount.isdecimal():
         return None
-    
-    value = int(match.group(1))
-    unit = match.group(2).lower()
-    
-    if unit in ["minute", "minutes"]:
-        return datetime.timedelta(minutes=value)
-    if unit in ["day", "days"]:
-        return datetime.timedelta(days=value)
-    if unit in ["week", "weeks"]:
-        return datetime.timedelta(weeks=value)
-    if unit in ["month", "months"]:
-        return datetime.timedelta(days=value * 30)
-    return None
+    unit = unit.strip().lower()
+    if unit.endswith("s"):
+        unit = unit[:-1]
+    step = DURATION_UNITS.get(unit)
+    return step * int(amount) if step else None
 
 PRIVATE_HELP_TEXT = """
 hello, how can i assist you?
@@ -158,22 +296,25 @@ Lets you view what’s been remembered in your conversation.
 ✅  AI assistant
 ✅ Generate and debug code
 ✅ Work in groups with /addtogroup
-✅ Support model switching & system instructions
+✅ Support model switching &amp; system instructions
 ✅ Absolutely free — no billing required
 """
 
 async def start_private(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(PRIVATE_HELP_TEXT, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(PRIVATE_HELP_TEXT, parse_mode=ParseMode.HTML)
 
 async def help_private(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(PRIVATE_HELP_TEXT, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(PRIVATE_HELP_TEXT, parse_mode=ParseMode.HTML)
 
-async def add_to_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    bot_username = (await context.bot.get_me()).username
+@functools.lru_cache(maxsize=1)
+def add_to_group_markup(bot_username):
     url = f"https://t.me/{bot_username}?startgroup=true"
-    keyboard = InlineKeyboardMarkup.from_button(
+    return InlineKeyboardMarkup.from_button(
         InlineKeyboardButton(text="Click to Add to Group", url=url)
     )
+
+async def add_to_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = add_to_group_markup(context.bot.username)
     await update.message.reply_text(
         "Lit! Click the button below to add me to your group.\n\n"
         "Remember, in groups I act as an **Admin Bot** 🛡️, not a chatbot.",
@@ -182,18 +323,21 @@ async def add_to_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def new_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    state = get_user_state(user_id)
-    state["history"] = []
+    async with user_state(update.effective_user.id) as state:
+        state["history"] = []
     await update.message.reply_text("Clean slate. Your chat history is cleared. 🧹")
 
 async def incognito_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    state = get_user_state(user_id)
-    state["incognito"] = not state["incognito"]
+    async with user_state(update.effective_user.id) as state:
+        state["incognito"] = not state["incognito"]
     status = "ON 🕵️ (chat history *won't* be saved)" if state["incognito"] else "OFF 💾 (chat history *will* be saved)"
     await update.message.reply_text(f"Incognito mode is now {status}.")
 
+HISTORY_TRUNCATED = "... (truncated)"
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
 async def chat_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     state = get_user_state(user_id)
@@ -202,15 +346,28 @@ async def chat_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("You have no chat history saved. Start a new chat!")
         return
 
-    history_text = "📜 **Your Chat History:**\n\n"
+    header = "📜 Your Chat History:\n\n"
+    # Telegram's limit applies to the text left after HTML parsing, counted in UTF-16 units.
+    budget = TELEGRAM_MESSAGE_LIMIT - utf16_len(header) - len(HISTORY_TRUNCATED) - 1
+    entries = []
     for item in state["history"]:
-        role = "You" if item['role'] == 'user' else "Gemini"
-        history_text += f"**{role}:** {item['parts'][0]}\n\n"
-        
-    if len(history_text) > 4096:
-        history_text = history_text[:4090] + "\n... (truncated)"
+        speaker = "You" if item["role"] == "user" else "Gemini"
+        text = " ".join(item["parts"])
+        prefix_len = len(speaker) + 2
+        if prefix_len + utf16_len(text) + 2 > budget:
+            room = budget - prefix_len
+            if room > 0:
+                text = text[:room]
+                while utf16_len(text) > room:
+                    text = text[:-1]
+                entries.append(f"<b>{speaker}:</b> {html.escape(text)}\n{HISTORY_TRUNCATED}")
+            else:
+                entries.append(HISTORY_TRUNCATED)
+            break
+        budget -= prefix_len + utf16_len(text) + 2
+        entries.append(f"<b>{speaker}:</b> {html.escape(text)}\n\n")
         
-    await update.message.reply_text(history_text, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text("📜 <b>Your Chat History:</b>\n\n" + "".join(entries), parse_mode=ParseMode.HTML)
 
 async def switch_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -229,9 +386,10 @@ async def switch_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     model_name = context.args[0].lower()
-    if model_name in available_models:
-        state["model"] = model_name
-        await update.message.reply_text(f"Bet. Switched model to `{state['model']}`.")
+    if model_name in available_model_set:
+        async with user_state(user_id) as state:
+            state["model"] = model_name
+        await update.message.reply_text(f"Bet. Switched model to `{model_name}`.")
     else:
         await update.message.reply_text("Nah, that's not a valid model. Type `/switchmodel` to see the list.")
 
@@ -239,7 +397,7 @@ async def set_instructions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     state = get_user_state(user_id)
     
-    instructions = " ".join(context.args)
+    instructions = get_command_text(update)
     if not instructions:
         await update.message.reply_text(
             f"**Current Instructions:**\n`{state['instructions']}`\n\n"
@@ -249,176 +407,246 @@ async def set_instructions(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
         
-    state["instructions"] = instructions
+    async with user_state(user_id) as state:
+        state["instructions"] = instructions
     await update.message.reply_text(f"Got it. System instructions updated. 🧠")
     
+TELEGRAM_MESSAGE_LIMIT = 4096
+STREAM_EDIT_INTERVAL = 1.0
+
+EMPTY_REPLY_TEXT = "Hmm, I got nothing back for that. Try rephrasing? 🤔"
+
+async def stream_reply(message, response):
+    sent = None
+    sent_text = ""
+    text = ""
+    last_edit = 0.0
+    replied = False
+
+    async def flush(final=False):
+        nonlocal sent, sent_text, last_edit, replied
+        # Telegram trims surrounding whitespace, so whitespace-only changes would be
+        # rejected as "message is not modified" (or as empty text on the first send).
+        if not text.strip() or text.strip() == sent_text.strip():
+            return
+        if not final and time.monotonic() - last_edit < STREAM_EDIT_INTERVAL:
+            return
+        if sent is None:
+            sent = await message.reply_text(text)
+        else:
+            await sent.edit_text(text)
+        sent_text = text
+        last_edit = time.monotonic()
+        replied = True
+
+    async for chunk in response:
+        # Finish-reason and safety chunks carry no parts, and reading .text on them raises.
+        if not chunk.candidates or not chunk.parts:
+            continue
+        text += chunk.text
+        while len(text) > TELEGRAM_MESSAGE_LIMIT:
+            overflow = text[TELEGRAM_MESSAGE_LIMIT:]
+            text = text[:TELEGRAM_MESSAGE_LIMIT]
+            await flush(final=True)
+            sent, sent_text, text = None, "", overflow
+        await flush()
+
+    await flush(final=True)
+    if not replied:
+        await message.reply_text(EMPTY_REPLY_TEXT)
+
+SUMMARY_KEEP = 4
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the following conversation in a few sentences. "
+    "Keep names, facts, user preferences and any open questions."
+)
+
+async def compact_history(model_name, history):
+    if len(history) <= MAX_HISTORY:
+        return history
+
+    older, recent = history[:-SUMMARY_KEEP], history[-SUMMARY_KEEP:]
+    transcript = "\n".join(f"{item['role']}: {' '.join(item['parts'])}" for item in older)
+    try:
+        summary = await get_model(model_name, SUMMARY_INSTRUCTIONS).generate_content_async(transcript)
+        summary_text = summary.text
+    except Exception as e:
+        logger.warning("Failed to summarize chat history: %s", e)
+        return history[-MAX_HISTORY:]
+
+    return [
+        {"role": "user", "parts": [f"Summary of our earlier conversation: {summary_text}"]},
+        {"role": "model", "parts": ["Got it."]},
+    ] + recent
+
 async def handle_gemini_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     prompt = update.message.text
-    state = get_user_state(user_id)
     
     if not GEMINI_API_KEY:
         await update.message.reply_text("Sry, the admin hasn't set up the Gemini API key. Can't chat rn. 😬")
         return
 
-    current_model = state["model"]
-    if current_model not in available_models:
-        logger.warning(f"User {user_id} had invalid model {current_model}. Reverting to default.")
-        current_model = DEFAULT_MODEL
-        state["model"] = DEFAULT_MODEL
-        await update.message.reply_text(f"Yo, your selected model wasn't valid. I switched you back to `{DEFAULT_MODEL}` for this chat.", parse_mode=ParseMode.MARKDOWN)
+    async with user_state(user_id) as state:
+        current_model = state["model"]
+        if current_model not in available_model_set:
+            logger.warning("User %s had invalid model %s. Reverting to default.", user_id, current_model)
+            current_model = DEFAULT_MODEL
+            state["model"] = DEFAULT_MODEL
+            await update.message.reply_text(f"Yo, your selected model wasn't valid. I switched you back to `{DEFAULT_MODEL}` for this chat.", parse_mode=ParseMode.MARKDOWN)
 
-    try:
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+        try:
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
         
-        model = genai.GenerativeModel(
-            model_name=current_model,
-            system_instruction=state["instructions"]
-        )
+            model = get_model(current_model, state["instructions"])
+            chat = model.start_chat(history=state["history"])
+            response = await chat.send_message_async(prompt, stream=True)
+            await stream_reply(update.message, response)
         
-        chat = model.start_chat(history=state["history"])
-        response = await chat.send_message_async(prompt)
+            if state["incognito"]:
+                return
+            try:
+                history = slim_history(chat.history)
+            except generation_types.BrokenResponseError as e:
+                # The stream stopped early (safety, recitation, ...). The user already has
+                # whatever came through, so just don't keep the unfinished turn.
+                logger.warning("Not storing incomplete Gemini reply for user %s: %s", user_id, e)
+                return
+            # Gemini rejects history entries without parts, so a turn with an empty reply
+            # would break every later message; leave it out along with its prompt.
+            if not history[-1]["parts"]:
+                return
+            state["history"] = history
         
-        if not state["incognito"]:
-            state["history"] = chat.history
+        except Exception as e:
+            logger.error("Gemini API error: %s", e)
+            await update.message.reply_text(f"Oof, something went wrong with the AI. Error: {e}")
+            return
 
-        await update.message.reply_text(response.text)
-        
-    except Exception as e:
-        logger.error(f"Gemini API error: {e}")
-        await update.message.reply_text(f"Oof, something went wrong with the AI. Error: {e}")
+    # Summarizing is a second Gemini call, so run it without holding the user's lock and
+    # only write it back if nothing (a new turn, /newchat) replaced the history meanwhile.
+    compacted = await compact_history(current_model, history)
+    if compacted is not history:
+        async with user_state(user_id) as state:
+            if state["history"] is history:
+                state["history"] = compacted
 
 GROUP_HELP_TEXT = """
-🛡️ **Admin Command Mode** 🛡️
+🛡️ <b>Admin Command Mode</b> 🛡️
 
 I'm in group mode. Only admins can use most commands.
 
 ---
 
-⚔️ **Moderation Commands**
+⚔️ <b>Moderation Commands</b>
 
-`/ban {user} {reason}`
+<code>/ban {user} {reason}</code>
 🚫 Permanently ban a member.
-Example: `/ban @user spamming`
+Example: <code>/ban @user spamming</code>
 
-`/unban {user_id or username}`
+<code>/unban {user_id or username}</code>
 ✅ Unban a previously banned user.
 
-`/tempban {user} {time} {reason}`
-⏳ Temp ban. Time: `10 minutes`, `2 days`, `1 week`
-Example: `/tempban @user 2 days timeout`
+<code>/tempban {user} {time} {reason}</code>
+⏳ Temp ban. Time: <code>10 minutes</code>, <code>2 days</code>, <code>1 week</code>
+Example: <code>/tempban @user 2 days timeout</code>
 
-`/mute {user} {time}`
+<code>/mute {user} {time}</code>
 🔇 Restrict a user for a specified time.
-Example: `/mute @user 30 minutes`
+Example: <code>/mute @user 30 minutes</code>
 
-`/unmute {user}`
+<code>/unmute {user}</code>
 🔊 Removes mute from a member.
 
 ---
 
-⚠️ **Warnings System**
+⚠️ <b>Warnings System</b>
 
-`/warning {user} {reason}`
+<code>/warning {user} {reason}</code>
 ⚠️ Give a warning. 3 warnings = 24h temp-ban (if automode=strict).
 
-`/removewarnings {user}`
+<code>/removewarnings {user}</code>
 🧹 Clears all warnings for a user.
 
-`/checkwarnings {optional @user}`
+<code>/checkwarnings {optional @user}</code>
 📋 Shows warning count.
 
 ---
 
-👑 **Role Management**
+👑 <b>Role Management</b>
 
-`/role {user}`
+<code>/role {user}</code>
 🎭 Promotes a user to admin with standard permissions.
 
-`/removerole {user}`
+<code>/removerole {user}</code>
 ❌ Demotes an admin back to a regular member.
 
 ---
 
-⚙️ **Auto & Mode Settings**
+⚙️ <b>Auto &amp; Mode Settings</b>
 
-`/setautomode {mode}`
+<code>/setautomode {mode}</code>
 ⚙️ Set moderation mode:
-`strict` 🔒 (auto-ban on 3 warnings, auto-censor)
-`normal` ⚖️ (warn only, auto-censor)
-`fun` 🎉 (light moderation, no censor)
+<code>strict</code> 🔒 (auto-ban on 3 warnings, auto-censor)
+<code>normal</code> ⚖️ (warn only, auto-censor)
+<code>fun</code> 🎉 (light moderation, no censor)
 
-`/removeautomode`
+<code>/removeautomode</code>
 🚫 Disables auto moderation (sets to normal).
 
 ---
 
-👋 **Welcome & Leaving Messages**
+👋 <b>Welcome &amp; Leaving Messages</b>
 
-`/welcomemessage {text}`
-👋 Sets custom welcome. Use `{user}` placeholder.
-Example: `/welcomemessage Welcome {user}! ❤️`
+<code>/welcomemessage {text}</code>
+👋 Sets custom welcome. Use <code>{user}</code> placeholder.
+Example: <code>/welcomemessage Welcome {user}! ❤️</code>
 
-`/leavingmessage {text}`
+<code>/leavingmessage {text}</code>
 😢 Sets custom leaving message.
-Example: `/leavingmessage Goodbye {user}!`
+Example: <code>/leavingmessage Goodbye {user}!</code>
 
 ---
 
-🗳️ **Polls & Fun** (Admin/Member)
+🗳️ <b>Polls &amp; Fun</b> (Admin/Member)
 
-`/poll {question} | {opt1} | {opt2} ...`
+<code>/poll {question} | {opt1} | {opt2} ...</code>
 📊 Create a quick poll.
 
-`/tictactoe {user}`
+<code>/tictactoe {user}</code>
 🎮 Play Tic-Tac-Toe with another member!
 
 ---
 
-👥 **Member Commands** (non-admins)
-`/checkwarnings` → view their own warnings
-`/poll` → create polls
-`/tictactoe` → start a match
-`/help` → show this list
+👥 <b>Member Commands</b> (non-admins)
+<code>/checkwarnings</code> → view their own warnings
+<code>/poll</code> → create polls
+<code>/tictactoe</code> → start a match
+<code>/help</code> → show this list
 """
 
 async def help_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(GROUP_HELP_TEXT, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(GROUP_HELP_TEXT, parse_mode=ParseMode.HTML)
 
 async def get_target_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    target_user = None
-    reason_parts = []
-    
     if update.message.reply_to_message:
-        target_user = update.message.reply_to_message.from_user
-        reason_parts = context.args
-    elif update.message.entities and context.args:
+        reason = " ".join(context.args) or "No reason provided."
+        return update.message.reply_to_message.from_user, reason
+
+    if context.args:
+        # Plain @username mentions can't be mapped to a user ID,
+        # so only reply and text_mention targets are supported.
         for entity in update.message.entities:
             if entity.type == 'text_mention':
-                target_user = entity.user
-                mention_length = entity.length
-                reason_text = update.message.text[entity.offset + mention_length:].strip()
-                reason_parts = reason_text.split()
-                break
-            elif entity.type == 'mention':
-                # This is harder, as username != ID.
-                # For simplicity, we'll mostly rely on reply and text_mention.
-                pass
-                
-    if not target_user:
-        await update.message.reply_text("Please reply to the user you want to action, or tag them in the command.")
-        return None, ""
+                reason_text = update.message.text[entity.offset + entity.length:]
+                return entity.user, " ".join(reason_text.split()) or "No reason provided."
 
-    reason = " ".join(reason_parts) if reason_parts else "No reason provided."
-    return target_user, reason
+    await update.message.reply_text("Please reply to the user you want to action, or tag them in the command.")
+    return None, ""
 
+@admin_only
 async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
 
     target_user, reason = await get_target_user(update, context)
     if not target_user:
@@ -426,18 +654,14 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     try:
         await context.bot.ban_chat_member(chat_id=chat_id, user_id=target_user.id)
-        mention = target_user.mention_markdown()
-        await update.message.reply_text(f"{mention}, you have been banned from this group! Reason: {reason}", parse_mode=ParseMode.MARKDOWN)
+        mention = target_user.mention_html()
+        await update.message.reply_text(f"{mention}, you have been banned from this group! Reason: {html.escape(reason)}", parse_mode=ParseMode.HTML)
     except Exception as e:
         await update.message.reply_text(f"Couldn't ban user. {e}")
 
+@admin_only
 async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
 
     if not context.args:
         await update.message.reply_text("Who? Use `/unban {user_id or @username}`")
@@ -458,13 +682,9 @@ async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"Couldn't unban user. {e}")
 
+@admin_only
 async def temp_ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
 
     target_user, reason_str = await get_target_user(update, context)
     if not target_user:
@@ -483,22 +703,18 @@ async def temp_ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Weird time format. Use: `10 minutes`, `2 days`, `1 week`")
         return
         
-    until_date = datetime.datetime.now() + duration
+    until_date = datetime.datetime.now(datetime.timezone.utc) + duration
     
     try:
         await context.bot.ban_chat_member(chat_id=chat_id, user_id=target_user.id, until_date=until_date)
-        mention = target_user.mention_markdown()
-        await update.message.reply_text(f"{mention}, you have been temp-banned for {duration_str}. Reason: {reason}", parse_mode=ParseMode.MARKDOWN)
+        mention = target_user.mention_html()
+        await update.message.reply_text(f"{mention}, you have been temp-banned for {html.escape(duration_str)}. Reason: {html.escape(reason)}", parse_mode=ParseMode.HTML)
     except Exception as e:
         await update.message.reply_text(f"Couldn't temp-ban user. {e}")
 
+@admin_only
 async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
 
     target_user, reason_str = await get_target_user(update, context)
     if not target_user:
@@ -516,27 +732,23 @@ async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Weird time format. Use: `10 minutes`, `2 days`, `1 week`")
         return
         
-    until_date = datetime.datetime.now() + duration
+    until_date = datetime.datetime.now(datetime.timezone.utc) + duration
     
     try:
         await context.bot.restrict_chat_member(
             chat_id=chat_id,
             user_id=target_user.id,
-            permissions=ChatPermissions(can_send_messages=False),
+            permissions=MUTED_PERMISSIONS,
             until_date=until_date
         )
-        mention = target_user.mention_markdown()
-        await update.message.reply_text(f"{mention}, you have been muted for {duration_str}. 🔇", parse_mode=ParseMode.MARKDOWN)
+        mention = target_user.mention_html()
+        await update.message.reply_text(f"{mention}, you have been muted for {html.escape(duration_str)}. 🔇", parse_mode=ParseMode.HTML)
     except Exception as e:
         await update.message.reply_text(f"Couldn't mute user. {e}")
 
+@admin_only
 async def unmute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
 
     target_user, _ = await get_target_user(update, context)
     if not target_user:
@@ -546,72 +758,50 @@ async def unmute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.restrict_chat_member(
             chat_id=chat_id,
             user_id=target_user.id,
-            permissions=ChatPermissions(
-                can_send_messages=True,
-                can_send_media_messages=True,
-                can_send_polls=True,
-                can_send_other_messages=True,
-                can_add_web_page_previews=True
-            )
+            permissions=UNMUTED_PERMISSIONS
         )
-        mention = target_user.mention_markdown()
-        await update.message.reply_text(f"{mention}, you have been unmuted. 🔊", parse_mode=ParseMode.MARKDOWN)
+        mention = target_user.mention_html()
+        await update.message.reply_text(f"{mention}, you have been unmuted. 🔊", parse_mode=ParseMode.HTML)
     except Exception as e:
         await update.message.reply_text(f"Couldn't unmute user. {e}")
 
+@admin_only
 async def warn_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
 
     target_user, reason = await get_target_user(update, context)
     if not target_user:
         return
         
     group = get_group_state(chat_id)
-    target_id_str = str(target_user.id)
+    group["warnings"][target_user.id] += 1
+    warnings = group["warnings"][target_user.id]
+    mention = target_user.mention_html()
     
-    if target_id_str not in group["warnings"]:
-        group["warnings"][target_id_str] = 0
-        
-    group["warnings"][target_id_str] += 1
-    warnings = group["warnings"][target_id_str]
-    mention = target_user.mention_markdown()
-    
-    await update.message.reply_text(f"⚠️ Warning issued to {mention}. Reason: {reason}\nThey now have {warnings}/3 warnings.", parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(f"⚠️ Warning issued to {mention}. Reason: {html.escape(reason)}\nThey now have {warnings}/3 warnings.", parse_mode=ParseMode.HTML)
     
     if warnings >= 3 and group["automode"] == "strict":
-        await update.message.reply_text(f"{mention} reached 3 warnings. Issuing 24-hour temp-ban.", parse_mode=ParseMode.MARKDOWN)
-        until_date = datetime.datetime.now() + datetime.timedelta(days=1)
+        await update.message.reply_text(f"{mention} reached 3 warnings. Issuing 24-hour temp-ban.", parse_mode=ParseMode.HTML)
+        until_date = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
         try:
             await context.bot.ban_chat_member(chat_id=chat_id, user_id=target_user.id, until_date=until_date)
-            group["warnings"][target_id_str] = 0
+            group["warnings"][target_user.id] = 0
         except Exception as e:
             await update.message.reply_text(f"Couldn't auto-ban user. {e}")
 
+@admin_only
 async def remove_warnings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
 
     target_user, _ = await get_target_user(update, context)
     if not target_user:
         return
         
     group = get_group_state(chat_id)
-    target_id_str = str(target_user.id)
-    
-    if target_id_str in group["warnings"]:
-        group["warnings"][target_id_str] = 0
+    group["warnings"].pop(target_user.id, None)
         
-    mention = target_user.mention_markdown()
-    await update.message.reply_text(f"Warnings cleared for {mention}. 🧹", parse_mode=ParseMode.MARKDOWN)
+    mention = target_user.mention_html()
+    await update.message.reply_text(f"Warnings cleared for {mention}. 🧹", parse_mode=ParseMode.HTML)
 
 async def check_warnings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -626,22 +816,17 @@ async def check_warnings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         target_user = update.effective_user
         
-    target_id_str = str(target_user.id)
-    warnings = group["warnings"].get(target_id_str, 0)
+    warnings = group["warnings"].get(target_user.id, 0)
     
     if target_user.id == update.effective_user.id:
         await update.message.reply_text(f"You have {warnings}/3 warnings. 📋")
     else:
-        mention = target_user.mention_markdown()
-        await update.message.reply_text(f"{mention} has {warnings}/3 warnings. 📋", parse_mode=ParseMode.MARKDOWN)
+        mention = target_user.mention_html()
+        await update.message.reply_text(f"{mention} has {warnings}/3 warnings. 📋", parse_mode=ParseMode.HTML)
 
+@admin_only
 async def promote_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
 
     target_user, _ = await get_target_user(update, context)
     if not target_user:
@@ -658,18 +843,15 @@ async def promote_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             can_pin_messages=True,
             can_manage_topics=True
         )
-        mention = target_user.mention_markdown()
-        await update.message.reply_text(f"Bet. {mention} is now an admin. 👑", parse_mode=ParseMode.MARKDOWN)
+        admin_cache.pop(chat_id, None)
+        mention = target_user.mention_html()
+        await update.message.reply_text(f"Bet. {mention} is now an admin. 👑", parse_mode=ParseMode.HTML)
     except Exception as e:
         await update.message.reply_text(f"Couldn't promote user. {e}")
 
+@admin_only
 async def demote_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
 
     target_user, _ = await get_target_user(update, context)
     if not target_user:
@@ -687,25 +869,25 @@ async def demote_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             can_manage_topics=False,
             can_promote_members=False
         )
-        mention = target_user.mention_markdown()
-        await update.message.reply_text(f"Aight. {mention} is no longer an admin. ❌", parse_mode=ParseMode.MARKDOWN)
+        admin_cache.pop(chat_id, None)
+        mention = target_user.mention_html()
+        await update.message.reply_text(f"Aight. {mention} is no longer an admin. ❌", parse_mode=ParseMode.HTML)
     except Exception as e:
         await update.message.reply_text(f"Couldn't demote user. {e}")
 
+AUTOMODES = frozenset({"strict", "normal", "fun"})
+CENSOR_MODES = frozenset({"strict", "normal"})
+
+@admin_only
 async def set_auto_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
-        
+
     if not context.args:
         await update.message.reply_text("Usage: `/setautomode {strict|normal|fun}`")
         return
         
     mode = context.args[0].lower()
-    if mode not in ["strict", "normal", "fun"]:
+    if mode not in AUTOMODES:
         await update.message.reply_text("Not a valid mode. Use `strict`, `normal`, or `fun`.")
         return
         
@@ -713,54 +895,42 @@ async def set_auto_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     group["automode"] = mode
     await update.message.reply_text(f"Auto-moderation mode set to: {mode} ⚙️")
 
+@admin_only
 async def remove_auto_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
-        
+
     group = get_group_state(chat_id)
     group["automode"] = "normal"
     await update.message.reply_text("Auto-moderation disabled (set to `normal`). 🚫")
 
+@admin_only
 async def set_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
-        
-    message = " ".join(context.args)
+
+    message = get_command_text(update)
     if not message:
         await update.message.reply_text("Usage: `/welcomemessage {text}`\nUse `{user}` as a placeholder.")
         return
         
     group = get_group_state(chat_id)
-    group["welcome_msg"] = message
+    group["welcome_parts"] = split_template(message)
     await update.message.reply_text(f"Welcome message set! 👋")
 
+@admin_only
 async def set_leaving(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if not await is_admin(chat_id, user_id, context):
-        await update.message.reply_text("You're not an admin, my guy.")
-        return
-        
-    message = " ".join(context.args)
+
+    message = get_command_text(update)
     if not message:
         await update.message.reply_text("Usage: `/leavingmessage {text}`\nUse `{user}` as a placeholder.")
         return
         
     group = get_group_state(chat_id)
-    group["leaving_msg"] = message
+    group["leaving_parts"] = split_template(message)
     await update.message.reply_text(f"Leaving message set! 😢")
 
 async def poll_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = " ".join(context.args)
+    text = get_command_text(update)
     parts = text.split('|')
     
     if len(parts) < 3:
@@ -787,9 +957,34 @@ async def poll_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def tictactoe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("TicTacToe feature is complex and under construction! 🚧")
 
+MEMBER_MESSAGE_DELAY = 2
+pending_member_mentions = {}
+
+def queue_member_message(chat_id, kind, mention, context: ContextTypes.DEFAULT_TYPE):
+    key = (chat_id, kind)
+    if key in pending_member_mentions:
+        pending_member_mentions[key].append(mention)
+        return
+    pending_member_mentions[key] = [mention]
+    context.application.create_task(flush_member_message(chat_id, kind, context.bot))
+
+async def flush_member_message(chat_id, kind, bot):
+    await asyncio.sleep(MEMBER_MESSAGE_DELAY)
+    mentions = pending_member_mentions.pop((chat_id, kind), [])
+    if not mentions or chat_id not in group_states:
+        return
+
+    template_parts = get_group_state(chat_id)[f"{kind}_parts"]
+    formatted_message = ", ".join(mentions).join(template_parts)
+    
+    try:
+        await bot.send_message(chat_id=chat_id, text=formatted_message, parse_mode=ParseMode.MARKDOWN)
+    except Exception as e:
+        logger.warning("Failed to send %s message: %s", kind, e)
+
 async def welcome_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    group = get_group_state(chat_id)
+    get_group_state(chat_id)
     
     bot_id = context.bot.id
     
@@ -805,35 +1000,28 @@ async def welcome_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             continue
             
-        message = group["welcome_msg"]
-        user_mention = new_member.mention_markdown()
-        formatted_message = message.replace("{user}", user_mention)
-        
-        try:
-            await update.message.reply_text(formatted_message, parse_mode=ParseMode.MARKDOWN)
-        except Exception as e:
-            logger.warning(f"Failed to send welcome message: {e}")
+        queue_member_message(chat_id, "welcome", new_member.mention_markdown(), context)
 
 async def leaving_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    group = get_group_state(chat_id)
+    get_group_state(chat_id)
     
     if update.message.left_chat_member:
         user = update.message.left_chat_member
         if user.id == context.bot.id:
-            logger.info(f"Bot was removed from group {chat_id}")
-            if chat_id in group_states:
-                del group_states[chat_id]
+            logger.info("Bot was removed from group %s", chat_id)
+            recent_groups.pop(chat_id, None)
+            context.application.drop_chat_data(chat_id)
             return
             
-        message = group["leaving_msg"]
         user_mention = user.mention_markdown() if user.username else user.first_name
-        formatted_message = message.replace("{user}", user_mention)
-        
-        try:
-            await context.bot.send_message(chat_id=chat_id, text=formatted_message, parse_mode=ParseMode.MARKDOWN)
-        except Exception as e:
-            logger.warning(f"Failed to send leaving message: {e}")
+        queue_member_message(chat_id, "leaving", user_mention, context)
+
+async def member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.new_chat_members:
+        await welcome_handler(update, context)
+    else:
+        await leaving_handler(update, context)
 
 async def censor_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.text:
@@ -843,7 +1031,7 @@ async def censor_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     group = get_group_state(chat_id)
     
-    if group["automode"] not in ["strict", "normal"]:
+    if group["automode"] not in CENSOR_MODES:
         return
         
     if await is_admin(chat_id, user_id, context):
@@ -862,9 +1050,128 @@ async def censor_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode=ParseMode.MARKDOWN
                 )
             except Exception as e:
-                logger.warning(f"Failed to delete/warn for censored message: {e}")
+                logger.warning("Failed to delete/warn for censored message: %s", e)
             return
 
+class BatchedPicklePersistence(PicklePersistence):
+    """PicklePersistence that rewrites the file at most once per update run, off the event loop.
+
+    Stock PicklePersistence dumps the whole file once for every changed user or chat.
+    Snapshots are written with plain pickle rather than PTB's bot-aware pickler, so only
+    single_file mode is supported and stored data must not contain Bot objects.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, on_flush=True, **kwargs)
+        if not self.single_file:
+            raise ValueError("BatchedPicklePersistence only supports single_file=True")
+        self._dirty = False
+        self._write_task = None
+
+    def _schedule_write(self):
+        self._dirty = True
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        while self._dirty:
+            self._dirty = False
+            # Entries are deep copies owned by the persistence and only ever replaced,
+            # so shallow copies of the top-level dicts are safe to pickle in a thread.
+            snapshot = {
+                "conversations": dict(self.conversations or {}),
+                "user_data": dict(self.user_data or {}),
+                "chat_data": dict(self.chat_data or {}),
+                "bot_data": self.bot_data,
+                "callback_data": self.callback_data,
+            }
+            await asyncio.to_thread(self._write_snapshot, snapshot)
+
+    def _write_snapshot(self, snapshot):
+        tmp_path = self.filepath.with_name(self.filepath.name + ".tmp")
+        with tmp_path.open("wb") as file:
+            pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.filepath)
+
+    async def update_user_data(self, user_id, data):
+        if data and (self.user_data or {}).get(user_id) != data:
+            await super().update_user_data(user_id, data)
+            self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        if data and (self.chat_data or {}).get(chat_id) != data:
+            await super().update_chat_data(chat_id, data)
+            self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        await super().drop_user_data(user_id)
+        self._schedule_write()
+
+    async def drop_chat_data(self, chat_id):
+        await super().drop_chat_data(chat_id)
+        self._schedule_write()
+
+    async def flush(self):
+        if self._write_task is not None:
+            await self._write_task
+        if self._dirty:
+            await self._write_pending()
+
+async def post_init(application: Application):
+    global user_states, group_states
+    user_states = application.user_data
+    group_states = application.chat_data
+    recent_users.on_evict = application.drop_user_data
+    recent_groups.on_evict = application.drop_chat_data
+    recent_users.update(dict.fromkeys(user_id for user_id, state in user_states.items() if state))
+    recent_groups.update(dict.fromkeys(chat_id for chat_id, group in group_states.items() if group))
+
+class FastJSONRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Bot API responses with orjson when it is installed."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        if orjson is not None:
+            try:
+                return orjson.loads(payload)
+            except orjson.JSONDecodeError:
+                pass
+        return HTTPXRequest.parse_json_payload(payload)
+
+PRIVATE_COMMANDS = (
+    ("start", start_private),
+    ("help", help_private),
+    ("addtogroup", add_to_group),
+    ("newchat", new_chat),
+    ("clearchat", new_chat),
+    ("incognitomode", incognito_mode),
+    ("chathistory", chat_history),
+    ("switchmodel", switch_model),
+    ("instructions", set_instructions),
+)
+
+GROUP_COMMANDS = (
+    ("help", help_group),
+    ("ban", ban_user),
+    ("unban", unban_user),
+    ("tempban", temp_ban_user),
+    ("mute", mute_user),
+    ("unmute", unmute_user),
+    ("warning", warn_user),
+    ("removewarnings", remove_warnings),
+    ("checkwarnings", check_warnings),
+    ("role", promote_user),
+    ("removerole", demote_user),
+    ("setautomode", set_auto_mode),
+    ("removeautomode", remove_auto_mode),
+    ("welcomemessage", set_welcome),
+    ("leavingmessage", set_leaving),
+    ("poll", poll_command),
+    ("tictactoe", tictactoe_command),
+)
+
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CHAT_MEMBER]
+
 def main():
     if not TELEGRAM_BOT_TOKEN:
         logger.critical("TELEGRAM_BOT_TOKEN env var not set.")
@@ -874,65 +1181,88 @@ def main():
         logger.critical("GEMINI_API_KEY env var not set. Bot cannot start.")
         return
 
+    if uvloop is not None:
+        uvloop.install()
+        logger.info("Using uvloop event loop.")
+
     fetch_available_models()
         
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .request(FastJSONRequest(
+            connection_pool_size=32,
+            pool_timeout=10.0,
+            connect_timeout=10.0,
+            read_timeout=20.0,
+            write_timeout=20.0,
+            http_version="2"
+        ))
+        .get_updates_request(FastJSONRequest(
+            connection_pool_size=4,
+            pool_timeout=60.0,
+            read_timeout=60.0,
+            http_version="2"
+        ))
+        .post_init(post_init)
+        .concurrent_updates(True)
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30,
+            overall_time_period=1,
+            group_max_rate=20,
+            group_time_period=60,
+            max_retries=3
+        ))
+    )
+    if PERSISTENCE_FILE:
+        builder.persistence(BatchedPicklePersistence(
+            filepath=PERSISTENCE_FILE,
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=60
+        ))
+    else:
+        logger.warning("PERSISTENCE_FILE env var not set. Chat history and group settings won't survive restarts.")
+    app = builder.build()
     
     private_filter = filters.ChatType.PRIVATE
-    app.add_handler(CommandHandler("start", start_private, filters=private_filter))
-    app.add_handler(CommandHandler("help", help_private, filters=private_filter))
-    app.add_handler(CommandHandler("addtogroup", add_to_group, filters=private_filter))
-    app.add_handler(CommandHandler("newchat", new_chat, filters=private_filter))
-    app.add_handler(CommandHandler("clearchat", new_chat, filters=private_filter))
-    app.add_handler(CommandHandler("incognitomode", incognito_mode, filters=private_filter))
-    app.add_handler(CommandHandler("chathistory", chat_history, filters=private_filter))
-    app.add_handler(CommandHandler("switchmodel", switch_model, filters=private_filter))
-    app.add_handler(CommandHandler("instructions", set_instructions, filters=private_filter))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & private_filter, handle_gemini_chat))
+    for command, callback in PRIVATE_COMMANDS:
+        app.add_handler(CommandHandler(command, callback, filters=private_filter))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & private_filter, handle_gemini_chat, block=False))
     
-    group_filter = filters.ChatType.GROUP | filters.ChatType.SUPERGROUP
-    app.add_handler(CommandHandler("help", help_group, filters=group_filter))
-    app.add_handler(CommandHandler("ban", ban_user, filters=group_filter))
-    app.add_handler(CommandHandler("unban", unban_user, filters=group_filter))
-    app.add_handler(CommandHandler("tempban", temp_ban_user, filters=group_filter))
-    app.add_handler(CommandHandler("mute", mute_user, filters=group_filter))
-    app.add_handler(CommandHandler("unmute", unmute_user, filters=group_filter))
-    app.add_handler(CommandHandler("warning", warn_user, filters=group_filter))
-    app.add_handler(CommandHandler("removewarnings", remove_warnings, filters=group_filter))
-    app.add_handler(CommandHandler("checkwarnings", check_warnings, filters=group_filter))
-    app.add_handler(CommandHandler("role", promote_user, filters=group_filter))
-    app.add_handler(CommandHandler("removerole", demote_user, filters=group_filter))
-    app.add_handler(CommandHandler("setautomode", set_auto_mode, filters=group_filter))
-    app.add_handler(CommandHandler("removeautomode", remove_auto_mode, filters=group_filter))
-    app.add_handler(CommandHandler("welcomemessage", set_welcome, filters=group_filter))
-    app.add_handler(CommandHandler("leavingmessage", set_leaving, filters=group_filter))
-    app.add_handler(CommandHandler("poll", poll_command, filters=group_filter))
-    app.add_handler(CommandHandler("tictactoe", tictactoe_command, filters=group_filter))
+    group_filter = filters.ChatType.GROUPS
+    member_filter = filters.StatusUpdate.NEW_CHAT_MEMBERS | filters.StatusUpdate.LEFT_CHAT_MEMBER
+    if ALLOWED_CHATS:
+        chat_allowlist = filters.Chat(chat_id=ALLOWED_CHATS)
+        group_filter &= chat_allowlist
+        member_filter &= chat_allowlist
+    for command, callback in GROUP_COMMANDS:
+        app.add_handler(CommandHandler(command, callback, filters=group_filter))
     
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & group_filter, censor_messages))
     
-    app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_handler))
-    app.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, leaving_handler))
-
-    PORT = int(os.environ.get('PORT', 8443))
-    RENDER_URL = os.environ.get('RENDER_URL') 
-
-    if not RENDER_URL:
-        logger.warning("RENDER_URL env var not set. Falling back to polling for local dev.")
-        logger.info("Starting bot with polling...")
-        app.run_polling(allowed_updates=Update.ALL_TYPES)
+    app.add_handler(ChatMemberHandler(track_admin_changes, ChatMemberHandler.CHAT_MEMBER))
+    app.add_handler(MessageHandler(member_filter, member_handler))
+
+    if BOT_MODE == "polling":
+        logger.info("Starting bot with long polling...")
+        app.run_polling(poll_interval=0.0, timeout=50, allowed_updates=ALLOWED_UPDATES)
+    elif not RENDER_URL:
+        logger.critical("RENDER_URL env var not set. Set BOT_MODE=polling for local dev.")
+        return
     else:
-        webhook_path = f"/{TELEGRAM_BOT_TOKEN}"
-        full_webhook_url = f"{RENDER_URL}{webhook_path}"
+        webhook_path = "tg"
+        full_webhook_url = f"{RENDER_URL}/{webhook_path}"
 
-        logger.info(f"Starting webhook server on 0.0.0.0:{PORT}...")
+        logger.info("Starting webhook server on 0.0.0.0:%d...", PORT)
         
         app.run_webhook(
             listen="0.0.0.0",
             port=PORT,
             url_path=webhook_path,
             webhook_url=full_webhook_url,
-            allowed_updates=Update.ALL_TYPES
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=True,
+            allowed_updates=ALLOWED_UPDATES
         )
 
 if __name__ == "__main__":